@@ -1,14 +1,16 @@
 VERSION = "v1.0.0"
 
 import os
+import time
 import uuid
-import json
+import orjson
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import datetime
 import asyncio
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException, Depends, Header
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException, Depends, Header, Request
+from fastapi.responses import FileResponse, HTMLResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
@@ -16,7 +18,8 @@ from backend.models import ProcessResponse, JobStatus
 from backend.extractor import extract_answers, extract_answers_async
 from backend.writer import fill_template
 from backend.mapping import Mapping, load_mapping
-from backend.config import MAPPING_CSV, EXCEL_TEMPLATE
+from backend.reader import shutdown_pool
+from backend.config import MAPPING_CSV, EXCEL_TEMPLATE, PDF_TEXT_CACHE
 
 load_dotenv()
 
@@ -38,13 +41,22 @@ BASE = Path(__file__).resolve().parent
 UPLOADS = BASE / "storage" / "uploads"
 OUTPUTS = BASE / "storage" / "outputs"
 JOBS_DIR = BASE / "storage" / "jobs"
-UPLOADS.mkdir(parents=True, exist_ok=True)
-OUTPUTS.mkdir(parents=True, exist_ok=True)
-JOBS_DIR.mkdir(parents=True, exist_ok=True)
 
 RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "60"))
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Cap on jobs running at once; extra uploads wait in "queued"
+MAX_JOBS = int(os.getenv("MAX_JOBS", "2"))
+JOB_SEM = asyncio.Semaphore(MAX_JOBS)
 
-app = FastAPI(title="AI Bid Assistant (MVP)")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Storage dirs are created once per server start rather than on every import
+    for d in (UPLOADS, OUTPUTS, JOBS_DIR, PDF_TEXT_CACHE):
+        d.mkdir(parents=True, exist_ok=True)
+    yield
+    shutdown_pool()
+
+app = FastAPI(title="AI Bid Assistant (MVP)", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -56,8 +68,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory job registry (good enough for local dev)
+# In-memory registry of jobs owned by this process; JOBS_DIR is the shared
+# store that lets any uvicorn worker answer /status for any job.
 JOBS = {}  # job_id -> JobStatus
+# Strong refs to running job tasks so they aren't garbage-collected mid-flight
+_BACKGROUND_TASKS = set()
+# Jobs with a debounced state write scheduled (see _set_job_message)
+_PENDING_SAVES = set()
+# Latest queued/in-flight threaded state write per job (see _queue_job_save)
+_STATE_WRITES = {}
+JOB_SAVE_DEBOUNCE = 0.5  # seconds
 
 def save_job_state(job_id: str):
     job = JOBS.get(job_id)
@@ -71,23 +91,65 @@ def save_job_state(job_id: str):
         "output_paths": job.get("output_paths", {}),
     }
     job_file = JOBS_DIR / f"{job_id}.json"
-    with job_file.open("w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    # Write-then-rename so other workers polling /status never read a partial file
+    tmp_file = job_file.with_suffix(".json.tmp")
+    tmp_file.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_file, job_file)
     print(f"[{job_id}] Job state saved to disk at {job_file}")
 
+def _queue_job_save(job_id: str) -> asyncio.Task:
+    """Run save_job_state in a worker thread, keeping the event loop free of file I/O.
+
+    Writes for one job are chained so they land in order: a slow progress write can
+    never replace the file after the final done/error state.
+    """
+    prev = _STATE_WRITES.get(job_id)
+
+    async def _write():
+        if prev is not None:
+            await asyncio.gather(prev, return_exceptions=True)
+        try:
+            await asyncio.to_thread(save_job_state, job_id)
+        except Exception as e:
+            print(f"[{job_id}] Failed to save job state: {e}")
+
+    task = asyncio.get_running_loop().create_task(_write())
+    _STATE_WRITES[job_id] = task
+
+    def _forget(t):
+        if _STATE_WRITES.get(job_id) is t:
+            del _STATE_WRITES[job_id]
+    task.add_done_callback(_forget)
+    return task
+
+def _flush_job_state(job_id: str):
+    _PENDING_SAVES.discard(job_id)
+    _queue_job_save(job_id)
+
+def _set_job_message(job_id: str, message: str):
+    """Update a job's progress message, persisting it at most once per JOB_SAVE_DEBOUNCE.
+
+    Consecutive updates for the same job collapse into one trailing write; terminal
+    states (done/error) are awaited via _queue_job_save so they land immediately.
+    """
+    JOBS[job_id]["message"] = message
+    print(f"[{job_id}] {message}")
+    if job_id not in _PENDING_SAVES:
+        _PENDING_SAVES.add(job_id)
+        asyncio.get_running_loop().call_later(JOB_SAVE_DEBOUNCE, _flush_job_state, job_id)
+
 def load_job_state(job_id: str):
+    # Not cached in JOBS: the job may be owned by another worker process that is
+    # still updating its file, so every poll re-reads the shared job directory.
     job_file = JOBS_DIR / f"{job_id}.json"
     if job_file.exists():
-        with job_file.open("r", encoding="utf-8") as f:
-            data = json.load(f)
-        JOBS[job_id] = {
+        data = orjson.loads(job_file.read_bytes())
+        return {
             "job_id": data.get("job_id"),
             "status": data.get("status"),
             "message": data.get("message"),
             "output_paths": data.get("output_paths", {}),
         }
-        print(f"[{job_id}] Job state loaded from disk at {job_file}")
-        return JOBS[job_id]
     return None
 
 @app.get("/", response_class=HTMLResponse)
@@ -114,8 +176,10 @@ async def process_pdf(background_tasks: BackgroundTasks, file: UploadFile = File
     ts = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
     pdf_name = f"{ts}__{job_id}__{file.filename}"
     pdf_path = UPLOADS / pdf_name
-    with pdf_path.open("wb") as f:
-        f.write(await file.read())
+    # stream the upload in 1 MiB chunks so memory stays flat for large bids
+    with pdf_path.open("wb", buffering=UPLOAD_CHUNK_SIZE) as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            f.write(chunk)
 
     # initialize job
     JOBS[job_id] = {
@@ -126,31 +190,36 @@ async def process_pdf(background_tasks: BackgroundTasks, file: UploadFile = File
     }
     save_job_state(job_id)
 
-    import threading
-    threading.Thread(target=lambda: asyncio.run(_process_job(job_id, pdf_path)), daemon=True).start()
+    task = asyncio.create_task(_process_job(job_id, pdf_path))
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
     return ProcessResponse(job_id=job_id, status="queued")
 
 async def _process_job(job_id: str, pdf_path: Path):
+    # Jobs stay "queued" until a slot frees up, so clients can see the wait
+    try:
+        async with JOB_SEM:
+            await _run_job(job_id, pdf_path)
+    finally:
+        # RETENTION_DAYS=0 means uploads are transient: the spooled PDF is only
+        # needed for text extraction, so drop it instead of waiting for /cleanup.
+        if RETENTION_DAYS <= 0:
+            pdf_path.unlink(missing_ok=True)
+
+async def _run_job(job_id: str, pdf_path: Path):
     try:
         JOBS[job_id]["status"] = "processing"
-        JOBS[job_id]["message"] = "Loading mapping"
-        save_job_state(job_id)
-        print(f"[{job_id}] Loading mapping")
+        _set_job_message(job_id, "Loading mapping")
 
         # 1) load mapping (handles your Numbers/CSV quirks)
-        mapping = load_mapping(MAPPING_CSV)
-        JOBS[job_id]["message"] = "Mapping loaded"
-        save_job_state(job_id)
-        print(f"[{job_id}] Mapping loaded")
+        # Blocking stages run in worker threads so the event loop keeps serving /status
+        mapping = await asyncio.to_thread(load_mapping, MAPPING_CSV)
+        _set_job_message(job_id, "Mapping loaded")
 
         # 2) extract answers from the PDF using OpenAI (returns dict keyed by json_key)
-        JOBS[job_id]["message"] = "Extracting answers from PDF"
-        save_job_state(job_id)
-        print(f"[{job_id}] Extracting answers from PDF")
+        _set_job_message(job_id, "Extracting answers from PDF")
         raw_answers = await extract_answers_async(pdf_path, mapping)
-        JOBS[job_id]["message"] = "Extraction complete"
-        save_job_state(job_id)
-        print(f"[{job_id}] Extraction complete")
+        _set_job_message(job_id, "Extraction complete")
 
         # Prepare structured answers including answer, confidence, and source
         structured_answers = {}
@@ -165,25 +234,20 @@ async def _process_job(job_id: str, pdf_path: Path):
                     "source": None,
                 }
 
-        JOBS[job_id]["message"] = "Writing JSON results"
-        save_job_state(job_id)
-        print(f"[{job_id}] Writing JSON results")
+        _set_job_message(job_id, "Writing JSON results")
 
         # 3) write raw JSON for debugging/auditing
         json_out = OUTPUTS / f"{pdf_path.stem}__{job_id}.json"
-        json_out.write_text(json.dumps(structured_answers, indent=2))
-        JOBS[job_id]["message"] = "JSON results written"
-        save_job_state(job_id)
-        print(f"[{job_id}] JSON results written")
+        # compact on disk; GET /download/<name>.json?pretty=1 returns it indented
+        payload = orjson.dumps(structured_answers)
+        await asyncio.to_thread(json_out.write_bytes, payload)
+        _set_job_message(job_id, "JSON results written")
 
         # 4) fill the real Excel template (preserves formatting/formulas)
-        JOBS[job_id]["message"] = "Filling Excel template"
-        save_job_state(job_id)
-        print(f"[{job_id}] Filling Excel template")
-        fill_template(mapping, structured_answers, xlsx_out := OUTPUTS / f"{pdf_path.stem}__{job_id}.xlsx")
-        JOBS[job_id]["message"] = "Excel template filled"
-        save_job_state(job_id)
-        print(f"[{job_id}] Excel template filled")
+        _set_job_message(job_id, "Filling Excel template")
+        xlsx_out = OUTPUTS / f"{pdf_path.stem}__{job_id}.xlsx"
+        await asyncio.to_thread(fill_template, mapping, structured_answers, xlsx_out)
+        _set_job_message(job_id, "Excel template filled")
 
         JOBS[job_id]["output_paths"] = {
             "json": f"/download/{json_out.name}",
@@ -191,14 +255,14 @@ async def _process_job(job_id: str, pdf_path: Path):
         }
         JOBS[job_id]["message"] = "Completed"
         JOBS[job_id]["status"] = "done"
-        save_job_state(job_id)
-        print(f"[{job_id}] Background job started successfully on thread")
+        await _queue_job_save(job_id)
+        print(f"[{job_id}] Background job completed")
     except Exception as e:
         import traceback
         traceback.print_exc()
         JOBS[job_id]["status"] = "error"
         JOBS[job_id]["message"] = str(e)
-        save_job_state(job_id)
+        await _queue_job_save(job_id)
 
 @app.get("/status/{job_id}", response_model=JobStatus)
 def status(job_id: str):
@@ -209,27 +273,52 @@ def status(job_id: str):
         raise HTTPException(status_code=404, detail="Unknown job")
     return JobStatus(**job)
 
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """If-None-Match check: `*` or any listed tag, compared weakly (W/ prefix ignored)."""
+    if not if_none_match:
+        return False
+    bare = etag.removeprefix("W/")
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == bare:
+            return True
+    return False
+
 @app.get(
     "/download/{filename}",
 )
-def download(filename: str):
+def download(filename: str, request: Request, pretty: bool = False):
     path = OUTPUTS / filename
     if not path.exists():
         raise HTTPException(status_code=404, detail="File not found")
+    if pretty and filename.endswith(".json"):
+        # results are stored compact; indent on demand for humans reading them
+        body = orjson.dumps(orjson.loads(path.read_bytes()), option=orjson.OPT_INDENT_2)
+        return Response(body, media_type="application/json", headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+    # Outputs never change after a job writes them, so a stat-based validator lets
+    # repeat downloads short-circuit to 304 instead of streaming the file again.
+    st = path.stat()
+    headers = {
+        "ETag": f'W/"{st.st_mtime_ns:x}-{st.st_size:x}"',
+        "Cache-Control": "private, max-age=3600",
+    }
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
     media = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet" if filename.endswith(".xlsx") else "application/json"
-    return FileResponse(path, media_type=media, filename=filename)
+    return FileResponse(path, media_type=media, filename=filename, headers=headers, stat_result=st)
 
 @app.delete(
     "/cleanup",
 )
 def cleanup():
-    # basic retention policy
-    cutoff = datetime.utcnow() - timedelta(days=RETENTION_DAYS)
+    # basic retention policy; scandir entries carry cached stat info, and raw
+    # epoch seconds avoid building a datetime per file
+    cutoff_ts = time.time() - RETENTION_DAYS * 86400
     removed = []
-    for folder in (UPLOADS, OUTPUTS):
-        for p in folder.iterdir():
-            if p.is_file():
-                if datetime.utcfromtimestamp(p.stat().st_mtime) < cutoff:
-                    p.unlink()
-                    removed.append(str(p.name))
+    for folder in (UPLOADS, OUTPUTS, PDF_TEXT_CACHE):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff_ts:
+                    os.unlink(entry.path)
+                    removed.append(entry.name)
     return {"removed": removed}
\ No newline at end of file
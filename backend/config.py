@@ -1,23 +1,30 @@
 import os
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
 load_dotenv(dotenv_path=Path(__file__).parent / ".env")
 
 BASE = Path(__file__).resolve().parent
 
 
+# Created by the app at startup, not on import
 UPLOADS = BASE / "storage" / "uploads"
 OUTPUTS = BASE / "storage" / "outputs"
-UPLOADS.mkdir(parents=True, exist_ok=True)
-OUTPUTS.mkdir(parents=True, exist_ok=True)
+# Extracted PDF page text, keyed by content hash (see reader.read_pdf_text_cached)
+PDF_TEXT_CACHE = BASE / "storage" / "text_cache"
 
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
 OPENAI_PROJECT = os.getenv("OPENAI_PROJECT", "").strip()
 MODEL_NAME     = os.getenv("MODEL_NAME", "gpt-4o-mini").strip()
 MODEL_TEMPERATURE = float(os.getenv("MODEL_TEMPERATURE", "0"))
+# Token budget for the document text sent with each extraction request
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "3000"))
+# Stop sending chunks once every key has an answer at least this confident (>10 disables)
+EARLY_EXIT_CONFIDENCE = int(os.getenv("EARLY_EXIT_CONFIDENCE", "9"))
+# Max OpenAI requests in flight per process, shared by every running job
+LLM_INFLIGHT_LIMIT = int(os.getenv("LLM_INFLIGHT_LIMIT", "10"))
 RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "60"))
 FRONTEND_ACCESS_TOKEN = os.getenv("FRONTEND_ACCESS_TOKEN", "").strip()
 
@@ -55,8 +62,12 @@ elif OPENAI_API_KEY.startswith(("sk-proj-", "sk-svcacct-")):
     if not OPENAI_PROJECT:
         print("[config] ERROR: Detected project/service-account key but OPENAI_PROJECT is not set. Requests will 401.")
 
-# OpenAI client (singleton)
+# OpenAI clients (singletons). The async client is shared by every extraction so
+# concurrent chunks and jobs reuse one keep-alive connection pool; it retries
+# 429/5xx itself with backoff that honours Retry-After.
 if OPENAI_PROJECT:
     CLIENT = OpenAI(api_key=OPENAI_API_KEY, project=OPENAI_PROJECT)
+    ASYNC_CLIENT = AsyncOpenAI(api_key=OPENAI_API_KEY, project=OPENAI_PROJECT, max_retries=5, timeout=60)
 else:
-    CLIENT = OpenAI(api_key=OPENAI_API_KEY)
\ No newline at end of file
+    CLIENT = OpenAI(api_key=OPENAI_API_KEY)
+    ASYNC_CLIENT = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=5, timeout=60)
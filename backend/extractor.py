@@ -1,16 +1,14 @@
 from __future__ import annotations
 from pathlib import Path
 import re
-import json
-import pdfplumber
-from typing import List, Dict
-from .config import MODEL_NAME, MODEL_TEMPERATURE
-from openai import AsyncOpenAI
-import random, time
-async_client = AsyncOpenAI()
+import orjson
+from typing import List, Dict, Tuple
+from .config import MODEL_NAME, MODEL_TEMPERATURE, EARLY_EXIT_CONFIDENCE, LLM_INFLIGHT_LIMIT, ASYNC_CLIENT as async_client
 from .mapping import Mapping
+from .reader import read_pdf_text_cached, chunk_text
 import asyncio
 import sys
+import weakref
 
 # Ensure MODEL_TEMPERATURE is a valid float between 0 and 1, else default to 0.3
 try:
@@ -21,36 +19,76 @@ except Exception:
     temp = 0.3
 MODEL_TEMPERATURE = temp
 
-def _read_pdf_text(pdf_path: Path, max_pages: int | None = None) -> List[str]:
-    """Extract text per page using pdfplumber. Returns a list of page texts."""
-    texts: List[str] = []
-    with pdfplumber.open(pdf_path) as pdf:
-        n = len(pdf.pages)
-        limit = min(n, max_pages) if max_pages else n
-        for i in range(limit):
-            try:
-                t = pdf.pages[i].extract_text() or ""
-            except Exception:
-                t = ""
-            # normalize whitespace and drop extra spaces
-            t = re.sub(r"[ \t]+", " ", t)
-            texts.append(t)
-    return texts
-
-def _chunk_text(pages: List[str], target_chars: int = 12000) -> List[str]:
-    """Group pages into chunks of ~target_chars to keep prompts small."""
-    chunks: List[str] = []
-    buf = ""
-    for p in pages:
-        if len(buf) + len(p) + 1 > target_chars:
-            if buf:
-                chunks.append(buf)
-            buf = p
-        else:
-            buf += ("\n" if buf else "") + p
-    if buf:
-        chunks.append(buf)
-    return chunks
+_WORD_RE = re.compile(r"[a-z]+")
+
+# One limiter per event loop (normally just the server's), so concurrent jobs
+# share the LLM_INFLIGHT_LIMIT budget instead of each getting their own
+_LLM_SEMS = weakref.WeakKeyDictionary()  # event loop -> asyncio.Semaphore
+
+def _llm_semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    sem = _LLM_SEMS.get(loop)
+    if sem is None:
+        sem = _LLM_SEMS[loop] = asyncio.Semaphore(LLM_INFLIGHT_LIMIT)
+    return sem
+
+# Generic question words that would match nearly every page of a bid document
+_KEYWORD_STOPWORDS = frozenset({
+    "what", "which", "with", "from", "that", "this", "there", "have",
+    "required", "allowed", "include", "beyond",
+})
+
+def _row_keywords(row) -> set:
+    """Distinctive words (4+ letters) from a question row's text and json_key."""
+    source = f"{row.text} {row.json_key.replace('_', ' ')}".lower()
+    return {w for w in _WORD_RE.findall(source) if len(w) >= 4 and w not in _KEYWORD_STOPWORDS}
+
+def _keyword_pattern(words) -> re.Pattern:
+    return re.compile(r"\b(?:" + "|".join(map(re.escape, sorted(words))) + ")", re.IGNORECASE)
+
+def _mapping_keywords(mapping: Mapping) -> List[str]:
+    """Distinctive words (4+ letters) from the question text and json_keys of the mapping."""
+    words = set()
+    for row in mapping.question_rows:
+        words |= _row_keywords(row)
+    return sorted(words)
+
+def _filter_pages(pages: List[str], mapping: Mapping) -> List[str]:
+    """Drop pages that mention none of the mapping keywords, so irrelevant pages
+    (drawings, blank or boilerplate pages) are never sent to the model.
+    Falls back to every page if nothing matches."""
+    keywords = _mapping_keywords(mapping)
+    if not keywords:
+        return pages
+    pattern = _keyword_pattern(keywords)
+    kept = [p for p in pages if pattern.search(p)]
+    return kept or pages
+
+def _route_keys(chunks: List[str], mapping: Mapping) -> List[Tuple[str, List[str]]]:
+    """Pair each chunk with only the keys whose question keywords it mentions.
+
+    Keys without distinctive keywords go to every chunk. Keys mentioned nowhere are
+    added to the two chunks that matched the most keys, so every key is still asked
+    somewhere without resending any text. Chunks that match no key are dropped.
+    """
+    patterns = {}
+    for row in mapping.question_rows:
+        if row.json_key:
+            words = _row_keywords(row)
+            patterns[row.json_key] = _keyword_pattern(words) if words else None
+    routed: List[Tuple[str, List[str]]] = []
+    matched_anywhere = set()
+    for chunk in chunks:
+        chunk_keys = [k for k, pat in patterns.items() if pat is None or pat.search(chunk)]
+        matched_anywhere.update(chunk_keys)
+        routed.append((chunk, chunk_keys))
+    unrouted = [k for k in patterns if k not in matched_anywhere]
+    if unrouted:
+        order = {k: i for i, k in enumerate(patterns)}
+        for i in sorted(range(len(routed)), key=lambda i: -len(routed[i][1]))[:2]:
+            routed[i][1].extend(unrouted)
+            routed[i][1].sort(key=order.__getitem__)
+    return [(chunk, ks) for chunk, ks in routed if ks]
 
 def _build_instructions(mapping: Mapping) -> str:
     lines = [
@@ -63,113 +101,112 @@ def _build_instructions(mapping: Mapping) -> str:
     ]
     return "\n".join(lines)
 
+def _response_format(keys: List[str]) -> Dict:
+    """Strict structured-output schema: every key maps to {answer, confidence, source}."""
+    answer_obj = {
+        "type": "object",
+        "properties": {
+            "answer": {"type": "string"},
+            "confidence": {"type": "integer"},
+            "source": {"type": "string"},
+        },
+        "required": ["answer", "confidence", "source"],
+        "additionalProperties": False,
+    }
+    schema = {
+        "type": "object",
+        "properties": {k: answer_obj for k in keys},
+        "required": list(keys),
+        "additionalProperties": False,
+    }
+    return {"type": "json_schema", "json_schema": {"name": "bid_answers", "schema": schema, "strict": True}}
+
 async def extract_answers_async(pdf_path: Path, mapping: Mapping, job_status: dict | None = None) -> Dict[str, object]:
     """
     Read the PDF, send relevant chunks to the model, and return a dict keyed by mapping.json_keys().
     """
-    # 1) Read and chunk PDF text
-    pages = _read_pdf_text(pdf_path)
-    chunks = _chunk_text(pages, target_chars=12000)
+    # 1) Read and chunk PDF text (off the event loop; pdf parsing is CPU-bound)
+    pages = await asyncio.to_thread(read_pdf_text_cached, pdf_path)
+    relevant = _filter_pages(pages, mapping)
+    print(f"[extractor] {len(relevant)}/{len(pages)} pages mention mapping keywords", file=sys.stderr)
+    # tokenizing (and tiktoken's first-use table load) stays off the event loop too
+    chunks = await asyncio.to_thread(chunk_text, relevant)
 
     # 2) Build prompt
     keys = mapping.json_keys()
     system_msg = _build_instructions(mapping)
+    # Each request only asks for the keys its chunk plausibly answers
+    jobs = _route_keys(chunks, mapping)
+    print(f"[extractor] {len(jobs)} request(s) for {len(chunks)} chunk(s); "
+          f"{sum(len(ks) for _, ks in jobs)} key asks vs {len(chunks) * len(keys)} unrouted", file=sys.stderr)
 
-    # Initialize output dictionary with None for all keys
-    out = {k: None for k in keys}
+    semaphore = _llm_semaphore()
 
-    semaphore = asyncio.Semaphore(3)
+    # Per-key type guidance with explicit examples, built once from mapping answer_types;
+    # each request then just picks the lines for its own keys
+    guidance_lines: Dict[str, str] = {}
+    for row in mapping.question_rows:
+        atype = getattr(row, "answer_type", "").lower().strip()
+        key = getattr(row, "json_key", "").strip()
+        if not key:
+            continue
+        if atype == "number":
+            guidance_lines[key] = f"- {key}: numeric value only (e.g., 5 or 10.0).\n"
+        elif atype == "currency":
+            guidance_lines[key] = f"- {key}: numeric currency (e.g., 5000 or 120000).\n"
+        elif atype in ("yes/no", "yesno"):
+            guidance_lines[key] = f"- {key}: strictly 'Yes' or 'No'.\n"
+        elif atype == "text":
+            guidance_lines[key] = f"- {key}: short text or name only.\n"
+        elif atype == "date":
+            guidance_lines[key] = f"- {key}: use YYYY-MM-DD format.\n"
+    system_message = {"role": "system", "content": system_msg}
 
-    async def _process_chunk(idx: int, chunk: str) -> Dict[str, object]:
-        # Build type guidance string from mapping.question_rows answer_types with explicit examples
-        type_guidance = "Answer each question using the correct type:\n"
-        for row in mapping.question_rows:
-            atype = getattr(row, "answer_type", "").lower().strip()
-            key = getattr(row, "json_key", "").strip()
-            if not key:
-                continue
-            if atype == "number":
-                type_guidance += f"- {key}: numeric value only (e.g., 5 or 10.0).\n"
-            elif atype == "currency":
-                type_guidance += f"- {key}: numeric currency (e.g., 5000 or 120000).\n"
-            elif atype in ("yes/no", "yesno"):
-                type_guidance += f"- {key}: strictly 'Yes' or 'No'.\n"
-            elif atype == "text":
-                type_guidance += f"- {key}: short text or name only.\n"
-            elif atype == "date":
-                type_guidance += f"- {key}: use YYYY-MM-DD format.\n"
-
-        messages = [{"role": "system", "content": system_msg}]
-        messages.append({
+    async def _process_chunk(idx: int, chunk: str, chunk_keys: List[str]) -> Tuple[int, Dict[str, object]]:
+        type_guidance = "Answer each question using the correct type:\n" + "".join(
+            guidance_lines[k] for k in chunk_keys if k in guidance_lines
+        )
+        messages = [system_message, {
             "role": "user",
             "content": (
-                "Answer ONLY these keys: " + ", ".join(keys) +
+                "Answer ONLY these keys: " + ", ".join(chunk_keys) +
                 ". Each key must map to {\"answer\": ..., \"confidence\": ..., \"source\": ...}. Confidence must be 1-10, source should be page numbers or context reference.\n" +
                 type_guidance +
                 "\nUse ONLY the document text below.\n\n" +
                 chunk
             )
-        })
+        }]
 
-        print(f"[extractor] Starting chunk {idx+1}/{len(chunks)}", file=sys.stderr)
+        print(f"[extractor] Starting chunk {idx+1}/{len(jobs)}", file=sys.stderr)
         print(f"[extractor] Using MODEL_TEMPERATURE={MODEL_TEMPERATURE}", file=sys.stderr)
         if job_status is not None:
-            job_status["progress"] = f"Starting chunk {idx+1}/{len(chunks)}"
-        attempt = 0
-        max_attempts = 5
-        while True:
-            try:
-                async with semaphore:
-                    resp = await async_client.chat.completions.create(
-                        model=MODEL_NAME,
-                        messages=messages,
-                        temperature=MODEL_TEMPERATURE,
-                        response_format={"type": "json_object"}
-                    )
-                break
-            except Exception as e:
-                code = getattr(e, 'code', None)
-                if (code == 429 or 'RateLimitError' in type(e).__name__) and attempt < max_attempts:
-                    delay = (2 ** attempt) + random.uniform(0, 1)
-                    print(f"[extractor] Rate limit hit, retrying in {delay:.2f}s (attempt {attempt+1})", file=sys.stderr)
-                    if job_status is not None:
-                        job_status["progress"] = f"Rate limit hit, retrying chunk {idx+1} in {delay:.2f}s (attempt {attempt+1})"
-                    await asyncio.sleep(delay)
-                    attempt += 1
-                    continue
-                else:
-                    raise
-
-        raw = resp.choices[0].message.content
+            job_status["progress"] = f"Starting chunk {idx+1}/{len(jobs)}"
+        # The shared client retries 429/5xx itself with backoff that honours Retry-After
+        async with semaphore:
+            resp = await async_client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+                temperature=MODEL_TEMPERATURE,
+                response_format=_response_format(chunk_keys)
+            )
+
+        raw = resp.choices[0].message.content or ""
         # Debug logging raw response truncated to 300 chars
         print(f"[extractor] Raw response chunk {idx+1} (truncated): {raw[:300]!r}", file=sys.stderr)
 
+        # Structured outputs guarantee well-formed JSON; this only trips on refusals
+        # or responses cut off by the token limit.
         try:
-            data = json.loads(raw)
+            data = orjson.loads(raw)
         except Exception:
-            # Attempt to extract first JSON object substring with regex
-            match = re.search(r"\{.*?\}", raw, re.DOTALL)
-            if match:
-                try:
-                    data = json.loads(match.group(0))
-                except Exception:
-                    print(f"[extractor] Failed to parse JSON from extracted substring in chunk {idx+1}", file=sys.stderr)
-                    print(f"[extractor] Raw response: {raw}", file=sys.stderr)
-                    data = {}
-            else:
-                print(f"[extractor] Failed to parse JSON and no JSON substring found in chunk {idx+1}", file=sys.stderr)
-                print(f"[extractor] Raw response: {raw}", file=sys.stderr)
-                data = {}
-
-        print(f"[extractor] Processing chunk {idx+1} of {len(chunks)}", file=sys.stderr)
-        if job_status is not None:
-            job_status["progress"] = f"Processing chunk {idx+1}/{len(chunks)}"
-        return data
+            print(f"[extractor] Failed to parse JSON in chunk {idx+1}", file=sys.stderr)
+            print(f"[extractor] Raw response: {raw}", file=sys.stderr)
+            data = {}
 
-    async def _run_all():
-        return await asyncio.gather(*[_process_chunk(i, chunk) for i, chunk in enumerate(chunks)])
-
-    results = await _run_all()
+        print(f"[extractor] Processing chunk {idx+1} of {len(jobs)}", file=sys.stderr)
+        if job_status is not None:
+            job_status["progress"] = f"Processing chunk {idx+1}/{len(jobs)}"
+        return idx, data
 
     # Merge answers across all chunks: parse each value as a dict with answer, confidence, source.
     def _normalize_answer(val):
@@ -196,43 +233,66 @@ async def extract_answers_async(pdf_path: Path, mapping: Mapping, job_status: di
             "source": source
         }
 
-    for data in results:
-        for k in keys:
-            val = data.get(k)
+    key_set = set(keys)
+    # Best candidate per key plus every distinct source cited for that answer
+    best: Dict[str, dict] = {}
+    sources: Dict[str, set] = {}
+
+    def _merge_chunk(data):
+        if not isinstance(data, dict):
+            return
+        # Only visit the keys this chunk actually answered
+        for k in key_set.intersection(data):
+            val = data[k]
             if val is None:
                 continue
-            val_obj = _normalize_answer(val)
-            # If out[k] is missing, set directly
-            if out[k] is None:
-                out[k] = val_obj
-                continue
-            # If out[k] is not a dict (legacy/empty), replace if blank/None
-            if not isinstance(out[k], dict):
-                if out[k] is None or out[k] == "" or (isinstance(out[k], str) and out[k].strip().lower() == "null"):
-                    out[k] = val_obj
-                continue
-            # If current answer is blank/None, replace
-            if (out[k].get("answer") is None) or (isinstance(out[k].get("answer"), str) and out[k].get("answer").strip() == ""):
-                out[k] = val_obj
-                continue
-            # Otherwise, prefer the answer with higher confidence
-            if val_obj["confidence"] > out[k].get("confidence", 0):
-                out[k] = val_obj
-                continue
-            # Otherwise, keep existing answer but merge sources
-            existing_source = out[k].get("source", "")
-            new_source = val_obj.get("source", "")
-            if new_source and new_source not in existing_source:
-                if existing_source.strip() == "":
-                    out[k]["source"] = new_source
-                else:
-                    out[k]["source"] = existing_source + "; " + new_source
-            continue
+            cand = _normalize_answer(val)
+            cur = best.get(k)
+            # Take the candidate if nothing usable is held yet or it is more confident;
+            # otherwise keep the existing answer and just record the extra source
+            if cur is None or not cur["answer"].strip() or cand["confidence"] > cur["confidence"]:
+                best[k] = cand
+                sources[k] = {cand["source"]} if cand["source"] else set()
+            elif cand["source"]:
+                sources[k].add(cand["source"])
+
+    def _all_confident() -> bool:
+        return len(best) == len(key_set) and all(
+            v["answer"].strip() and v["confidence"] >= EARLY_EXIT_CONFIDENCE
+            for v in best.values()
+        )
+
+    # Merge results as chunks finish, but fold them in chunk order so ties resolve
+    # exactly as before; stop early (cancelling unsent/in-flight chunks) once every
+    # key already has a confident answer.
+    tasks = [asyncio.create_task(_process_chunk(i, chunk, ks)) for i, (chunk, ks) in enumerate(jobs)]
+    finished: Dict[int, object] = {}
+    next_idx = 0
+    try:
+        for fut in asyncio.as_completed(tasks):
+            idx, data = await fut
+            finished[idx] = data
+            while next_idx in finished:
+                _merge_chunk(finished.pop(next_idx))
+                next_idx += 1
+            if _all_confident():
+                if next_idx < len(jobs):
+                    print(f"[extractor] All keys answered with confidence >= {EARLY_EXIT_CONFIDENCE}; skipping {len(jobs) - next_idx} remaining chunk(s)", file=sys.stderr)
+                break
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
     # Ensure all keys have a structured answer object
+    out = {}
     for k in keys:
-        if out[k] is None:
+        v = best.get(k)
+        if v is None:
             out[k] = {"answer": "", "confidence": 1, "source": ""}
+        else:
+            v["source"] = "; ".join(sorted(sources[k]))
+            out[k] = v
 
     if job_status is not None:
         job_status["result"] = out
@@ -1,6 +1,8 @@
 from __future__ import annotations
-import csv, io, re
+import codecs, csv, io, re
+from collections import Counter
 from dataclasses import dataclass, field
+from functools import lru_cache, cached_property
 from pathlib import Path
 from typing import List, Dict
 import chardet  # make sure 'chardet' is in requirements.txt
@@ -8,6 +10,49 @@ import chardet  # make sure 'chardet' is in requirements.txt
 REQUIRED_HEADERS = ["sheet","cell","text","is_question","json_key","answer_type","notes"]
 ALLOWED_TYPES = {"text","date","number","currency","yesno","list","email","phone","location"}
 
+_KEY_RE = re.compile(r"^[a-z0-9_]+$")
+_CELL_RE = re.compile(r"^[A-Za-z]{1,3}[0-9]{1,6}$")
+
+# Map common header variants → required names
+_HEADER_MAP = {
+    "sheet name":"sheet","worksheet":"sheet",
+    "cell address":"cell",
+    "question":"text","label":"text","prompt":"text",
+    "isquestion":"is_question","yes/no":"is_question","is question":"is_question",
+    "json key":"json_key","json-key":"json_key",
+    "answer type":"answer_type","type":"answer_type",
+}
+
+# answer_type aliases, looked up after removing spaces, slashes and hyphens
+_ALIAS_MAP = {
+    "yesno": "yesno",
+    "yesn": "yesno",           # occasional typo
+    "yn": "yesno",
+    "boolean": "yesno",
+    "pct": "number",
+    "percentage": "number",
+    "percent": "number",
+    "money": "currency",
+    "usd": "currency",
+    "dollars": "currency",
+    "phonenumber": "phone",
+    "telephone": "phone",
+    "tel": "phone",
+    "emailaddress": "email",
+    "email": "email",
+    "e-mail": "email",
+    "locationaddress": "location",
+    "addr": "location",
+    # date/time combos & variants
+    "datetime": "date",
+    "dateandtime": "date",
+    "date_time": "date",
+    "datetimelocation": "text",   # treat combined date/time/location as free text
+    "dateandtimelocation": "text",
+    "date/time": "date",
+    "date-time": "date",
+}
+
 @dataclass
 class MapRow:
     sheet: str
@@ -22,14 +67,20 @@ class MapRow:
 
 @dataclass
 class Mapping:
+    # rows are not modified after construction, so the derived views below are
+    # computed on first access and cached on the instance
     rows: List[MapRow]
 
-    @property
+    @cached_property
     def question_rows(self) -> List[MapRow]:
         return [r for r in self.rows if r.is_question]
 
+    @cached_property
+    def _json_keys(self) -> tuple:
+        return tuple(r.json_key for r in self.question_rows if r.json_key)
+
     def json_keys(self) -> List[str]:
-        return [r.json_key for r in self.question_rows if r.json_key]
+        return list(self._json_keys)
 
     def schema(self) -> Dict:
         tmap = {
@@ -57,30 +108,35 @@ class Mapping:
             }
         return {"type":"object","properties":props}
 
-    @property
+    @cached_property
     def by_sheet(self) -> Dict[str, List[MapRow]]:
         sheet_map: Dict[str, List[MapRow]] = {}
         for row in self.rows:
             sheet_map.setdefault(row.sheet, []).append(row)
         return sheet_map
 
-    def by_json_key(self) -> Dict[str, MapRow]:
+    @cached_property
+    def _by_json_key(self) -> Dict[str, MapRow]:
         return {row.json_key: row for row in self.rows if row.json_key}
 
+    def by_json_key(self) -> Dict[str, MapRow]:
+        return self._by_json_key
+
     def __repr__(self) -> str:
         return f"<Mapping rows={len(self.rows)} questions={len(self.question_rows)} keys={self.json_keys()[:5]}...>"
 
 def _sniff_and_split_singlecol(lines: list[str]) -> list[dict]:
-    # Try common delimiters to split a single “all-in-one” column file
+    # Try common delimiters to split a single “all-in-one” column file; only the
+    # header line is split per candidate, and csv.reader keeps quoted delimiters intact
+    lines = [row for row in lines if row is not None]
+    if not lines:
+        return []
     for delim in [",",";","\t","|"]:
-        parts = [row.split(delim) for row in lines if row is not None]
-        if not parts:
-            continue
-        headers = [h.strip().lower() for h in parts[0]]
+        headers = [h.strip().lower() for h in next(csv.reader([lines[0]], delimiter=delim), [])]
         if len(headers) < 3:  # too few to be our mapping
             continue
         rows = []
-        for row in parts[1:]:
+        for row in csv.reader(lines[1:], delimiter=delim):
             row += [""] * (len(headers)-len(row))
             rows.append({headers[i]: row[i].strip() for i in range(len(headers))})
         return rows
@@ -91,9 +147,27 @@ def _norm_bool(v: str) -> bool:
     return s in ("y","yes","true","1")
 
 def load_mapping(path: Path) -> Mapping:
+    """Load the mapping CSV, re-parsing only when the file's mtime changes."""
+    path = Path(path)
+    # Shared across jobs: nothing mutates the rows once loaded
+    return _load_mapping_cached(str(path), path.stat().st_mtime_ns)
+
+@lru_cache(maxsize=4)
+def _load_mapping_cached(path: str, mtime_ns: int) -> Mapping:
+    return _load_mapping_impl(Path(path))
+
+def _load_mapping_impl(path: Path) -> Mapping:
     raw = path.read_bytes()
-    enc = chardet.detect(raw).get("encoding") or "utf-8"
-    text = raw.decode(enc, errors="replace")
+    # Most exports are UTF-8 (often with a BOM); only run chardet's full-buffer scan
+    # when the bytes aren't valid UTF-8
+    if raw.startswith(codecs.BOM_UTF8):
+        text = raw[len(codecs.BOM_UTF8):].decode("utf-8", errors="replace")
+    else:
+        try:
+            text = raw.decode("utf-8")
+        except UnicodeDecodeError:
+            enc = chardet.detect(raw).get("encoding") or "utf-8"
+            text = raw.decode(enc, errors="replace")
 
     # If the first line is a lone token (no typical delimiters) but the second line looks like a header,
     # drop the first line to tolerate exports with a stray title row.
@@ -121,20 +195,11 @@ def load_mapping(path: Path) -> Mapping:
     if not rows:
         raise ValueError("Could not parse mapping CSV")
 
-    # Map common header variants → required names
-    header_map = {
-        "sheet name":"sheet","worksheet":"sheet",
-        "cell address":"cell",
-        "question":"text","label":"text","prompt":"text",
-        "isquestion":"is_question","yes/no":"is_question","is question":"is_question",
-        "json key":"json_key","json-key":"json_key",
-        "answer type":"answer_type","type":"answer_type",
-    }
     norm_rows = []
     for r in rows:
         nr = {}
         for k, v in r.items():
-            k2 = header_map.get(k, k)
+            k2 = _HEADER_MAP.get(k, k)
             nr[k2] = v
         # ensure required headers exist
         for h in REQUIRED_HEADERS:
@@ -145,11 +210,9 @@ def load_mapping(path: Path) -> Mapping:
         norm_rows.append(nr)
 
     # Build structured rows and validate keys/types
-    key_re = re.compile(r"^[a-z0-9_]+$")
-    cell_re = re.compile(r"^[A-Za-z]{1,3}[0-9]{1,6}$")
     warnings: list[str] = []
     out: list[MapRow] = []
-    seen_keys: list[str] = []
+    seen_keys: Counter[str] = Counter()
 
     for r in norm_rows:
         isq = _norm_bool(r.get("is_question",""))
@@ -158,38 +221,10 @@ def load_mapping(path: Path) -> Mapping:
         at_raw = (r.get("answer_type", "") or "text").strip().lower()
         # normalize common variants: remove spaces, slashes, hyphens for alias matching
         at_simple = at_raw.replace(" ", "").replace("/", "").replace("-", "")
-        alias_map = {
-            "yesno": "yesno",
-            "yesn": "yesno",           # occasional typo
-            "yn": "yesno",
-            "boolean": "yesno",
-            "pct": "number",
-            "percentage": "number",
-            "percent": "number",
-            "money": "currency",
-            "usd": "currency",
-            "dollars": "currency",
-            "phonenumber": "phone",
-            "telephone": "phone",
-            "tel": "phone",
-            "emailaddress": "email",
-            "email": "email",
-            "e-mail": "email",
-            "locationaddress": "location",
-            "addr": "location",
-            # date/time combos & variants
-            "datetime": "date",
-            "dateandtime": "date",
-            "date_time": "date",
-            "datetimelocation": "text",   # treat combined date/time/location as free text
-            "dateandtimelocation": "text",
-            "date/time": "date",
-            "date-time": "date",
-        }
-        at = alias_map.get(at_simple, at_raw)
+        at = _ALIAS_MAP.get(at_simple, at_raw)
 
         if isq:
-            if key and not key_re.match(key):
+            if key and not _KEY_RE.match(key):
                 raise ValueError(f"Invalid json_key '{key}' (use lowercase/underscores only).")
             if at not in ALLOWED_TYPES:
                 raise ValueError(f"Unknown answer_type '{at}' for key '{key}'.")
@@ -198,7 +233,7 @@ def load_mapping(path: Path) -> Mapping:
         if isq:
             if not (r.get("cell", "").strip()):
                 warnings.append(f"Missing cell for question key '{key}' on sheet '{(r.get('sheet','') or 'Bid Information').strip()}'")
-            elif not cell_re.match((r.get("cell", "") or "").strip()):
+            elif not _CELL_RE.match((r.get("cell", "") or "").strip()):
                 warnings.append(f"Suspicious cell address '{(r.get('cell','') or '').strip()}' for key '{key}'")
 
         try:
@@ -218,10 +253,10 @@ def load_mapping(path: Path) -> Mapping:
             source=(r.get("source","") or "").strip(),
         ))
         if isq and key:
-            seen_keys.append(key)
+            seen_keys[key] += 1
 
     # duplicate key guard
-    dups = {k for k in seen_keys if seen_keys.count(k) > 1}
+    dups = [k for k, n in seen_keys.items() if n > 1]
     if dups:
         raise ValueError(f"Duplicate json_key(s): {sorted(dups)}")
 
@@ -0,0 +1,167 @@
+from __future__ import annotations
+from pathlib import Path
+import re
+import gzip
+import hashlib
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Callable, List, Tuple
+import orjson
+import pymupdf
+import tiktoken
+from .config import MODEL_NAME, CHUNK_TOKENS, PDF_TEXT_CACHE, RETENTION_DAYS
+
+_WS_RE = re.compile(r"[ \t]+")
+
+# Below this many pages, starting worker processes costs more than it saves
+_PARALLEL_MIN_PAGES = 8
+
+def _extract_pages(pdf_path: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    """Extract normalized text for pages [start, stop) as (index, text) pairs.
+    Module-level so worker processes can run it; each call opens the PDF once."""
+    texts: List[Tuple[int, str]] = []
+    with pymupdf.open(pdf_path) as doc:
+        for i in range(start, stop):
+            try:
+                page = doc[i]
+                # A page with no fonts has no text to find (scans, drawings); skip
+                # decoding its possibly huge content stream. get_fonts() doesn't see
+                # fonts used by form fields or annotations, so filled-in forms are
+                # always read.
+                if page.get_fonts() or page.first_annot is not None or page.first_widget is not None:
+                    t = page.get_text("text")
+                else:
+                    t = ""
+            except Exception:
+                t = ""
+            # normalize whitespace and drop extra spaces
+            texts.append((i, _WS_RE.sub(" ", t)))
+    return texts
+
+# One worker pool per server process, shared by every job and created on first use.
+# forkserver (not fork): jobs run in threads, and forking a threaded process can
+# copy another thread's held lock into the child and deadlock it.
+_POOL: ProcessPoolExecutor | None = None
+_POOL_LOCK = threading.Lock()
+
+def _pool() -> ProcessPoolExecutor:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _POOL = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context(method))
+        return _POOL
+
+def shutdown_pool():
+    """Stop the extraction worker pool (called on app shutdown)."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(cancel_futures=True)
+            _POOL = None
+
+def read_pdf_text(pdf_path: Path, max_pages: int | None = None) -> List[str]:
+    """Extract text per page using PyMuPDF. Large PDFs are split into contiguous
+    page ranges across a process pool. Returns a list of page texts in page order."""
+    with pymupdf.open(pdf_path) as doc:
+        n = doc.page_count
+    limit = min(n, max_pages) if max_pages else n
+    cpus = os.cpu_count() or 1
+    if limit < _PARALLEL_MIN_PAGES or cpus == 1:
+        pairs = _extract_pages(str(pdf_path), 0, limit)
+    else:
+        step = -(-limit // min(cpus, limit))  # ceil division
+        try:
+            ex = _pool()
+            futures = [ex.submit(_extract_pages, str(pdf_path), start, min(start + step, limit))
+                       for start in range(0, limit, step)]
+            pairs = [pair for f in futures for pair in f.result()]
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM); drop the pool so the next job starts a fresh one
+            print("[reader] extraction pool broken; reading serially", file=sys.stderr)
+            shutdown_pool()
+            pairs = _extract_pages(str(pdf_path), 0, limit)
+    pairs.sort()
+    return [t for _, t in pairs]
+
+# Bump when read_pdf_text's output changes so stale cache entries are ignored
+_TEXT_CACHE_VERSION = 2
+
+def _pdf_digest(pdf_path: Path) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def read_pdf_text_cached(pdf_path: Path) -> List[str]:
+    """read_pdf_text with an on-disk cache keyed by the PDF's content hash, so re-running
+    the same document (e.g. after a mapping tweak) skips parsing. Cache failures only log.
+    With RETENTION_DAYS <= 0 uploads are transient, so the document text isn't cached either."""
+    if RETENTION_DAYS <= 0:
+        return read_pdf_text(pdf_path)
+    cache_file = None
+    try:
+        cache_file = PDF_TEXT_CACHE / f"v{_TEXT_CACHE_VERSION}-{_pdf_digest(pdf_path)}.json.gz"
+        if cache_file.exists():
+            pages = orjson.loads(gzip.decompress(cache_file.read_bytes()))
+            print(f"[reader] PDF text cache hit ({cache_file.name})", file=sys.stderr)
+            return pages
+    except Exception as e:
+        print(f"[reader] PDF text cache read failed: {e}", file=sys.stderr)
+
+    pages = read_pdf_text(pdf_path)
+
+    if cache_file is not None:
+        try:
+            PDF_TEXT_CACHE.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+            tmp_file.write_bytes(gzip.compress(orjson.dumps(pages)))
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            print(f"[reader] PDF text cache write failed: {e}", file=sys.stderr)
+    return pages
+
+@lru_cache(maxsize=1)
+def _token_counter() -> Callable[[str], int]:
+    """Return a function counting MODEL_NAME tokens in a string.
+
+    tiktoken downloads its BPE tables on first use; if that fails (offline host,
+    unknown model) fall back to the usual ~4 characters per token estimate.
+    """
+    try:
+        try:
+            enc = tiktoken.encoding_for_model(MODEL_NAME)
+        except KeyError:
+            enc = tiktoken.get_encoding("o200k_base")
+        return lambda s: len(enc.encode_ordinary(s))
+    except Exception as e:
+        print(f"[reader] tiktoken unavailable ({e}); estimating tokens from length", file=sys.stderr)
+        return lambda s: len(s) // 4 + 1
+
+def chunk_text(pages: List[str], target_tokens: int = CHUNK_TOKENS) -> List[str]:
+    """Group pages into chunks of ~target_tokens model tokens to keep prompts small."""
+    count_tokens = _token_counter()
+    chunks: List[str] = []
+    buf_parts: List[str] = []
+    buf_tokens = 0
+    for p in pages:
+        if not p:
+            continue  # blank page (e.g. a scan) adds nothing to the prompt
+        n = count_tokens(p)
+        if buf_tokens + n + 1 > target_tokens:
+            if buf_parts:
+                chunks.append("\n".join(buf_parts))
+            buf_parts = [p]
+            buf_tokens = n
+        else:
+            buf_parts.append(p)
+            buf_tokens += n + 1
+    if buf_parts:
+        chunks.append("\n".join(buf_parts))
+    return chunks
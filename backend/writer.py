@@ -2,28 +2,32 @@ from __future__ import annotations
 from pathlib import Path
 from typing import Any, Dict
 from datetime import datetime
+from functools import lru_cache
+from io import BytesIO
 from openpyxl import load_workbook
+from openpyxl.utils.cell import coordinate_from_string
 import logging
+import math
+import re
+
+_CONF_RE = re.compile(r"-?\d*\.?\d+")
 
 def _coerce_confidence(val: Any) -> int:
   """Coerce a confidence value to an integer 1..10. Defaults to 3 if missing/invalid."""
   try:
-    if val is None:
+    if isinstance(val, int):
+      n = val
+    elif isinstance(val, float):
+      n = int(round(val))
+    elif val is None:
       return 3
-    if isinstance(val, (int, float)):
-      n = int(round(float(val)))
     else:
-      s = str(val).strip()
-      if not s:
+      # first number in the string, e.g. "8", "8/10", "confidence: 7.5"
+      m = _CONF_RE.search(str(val))
+      if not m:
         return 3
-      # extract leading number if present
-      num = "".join(ch for ch in s if (ch.isdigit() or ch == "."))
-      n = int(round(float(num))) if num else 3
-    if n < 1:
-      return 1
-    if n > 10:
-      return 10
-    return n
+      n = int(round(float(m.group())))
+    return max(1, min(10, n))
   except Exception:
     return 3
 
@@ -41,9 +45,7 @@ def _extract_structured(answer_value: Any) -> tuple[Any, int, str]:
            answer_value.get("value") or
            answer_value.get("text") or
            answer_value.get("result") or
-           None)
-    if val is None:
-      val = "Unknown"
+           "Unknown")
     # confidence
     conf = _coerce_confidence(answer_value.get("confidence"))
     # source / page(s)
@@ -52,7 +54,7 @@ def _extract_structured(answer_value: Any) -> tuple[Any, int, str]:
            answer_value.get("source_page") or
            answer_value.get("source_pages") or
            None)
-    if src is None or src == "":
+    if src is None:
       source = "Unknown"
     elif isinstance(src, (list, tuple)):
       # Join multiple pages
@@ -68,38 +70,40 @@ def _extract_structured(answer_value: Any) -> tuple[Any, int, str]:
   return val, conf, source
 
 def _write_conf_source(ws, row_idx: int, conf: int, source: str):
-  """Write Confidence (col C) and Source (col D)."""
-  # Ensure confidence between 1 and 10, default 3
-  if not isinstance(conf, int):
-    conf = 3
-  if conf < 1:
-    conf = 1
-  if conf > 10:
-    conf = 10
+  """Write Confidence (col C) and Source (col D). `conf` is already clamped by _coerce_confidence."""
   # Ensure source is a non-empty string
   if source is None or str(source).strip() == "":
     source = "Unknown"
   ws.cell(row=row_idx, column=3, value=conf)
   ws.cell(row=row_idx, column=4, value=source)
 
+from .config import EXCEL_TEMPLATE
 from .mapping import Mapping
 
+_NUM_STRIP = re.compile(r"[$,%\s]")
+
 def _try_parse_number(value: Any) -> Any:
   if value is None:
     return None
   if isinstance(value, (int, float)):
     return value
-  s = str(value).strip()
+  # Remove currency symbols, commas and whitespace in one pass
+  s = _NUM_STRIP.sub("", str(value))
   if not s:
     return None
-  # Remove currency symbols and commas
-  s = s.replace("$", "").replace(",", "").replace("%", "")
+  if "." not in s:
+    # int() keeps large integers exact; float() would round them past 2**53
+    try:
+      return int(s)
+    except ValueError:
+      pass
   try:
-    if "." in s:
-      return float(s)
-    return int(s)
-  except Exception:
+    f = float(s)
+  except ValueError:
     return value  # fall back to original
+  if not math.isfinite(f):
+    return value
+  return int(f) if "." not in s and f.is_integer() else f
 
 def _try_parse_date(value: Any):
   """Return a python date for common formats so Excel can format it nicely, else return original."""
@@ -110,71 +114,94 @@ def _try_parse_date(value: Any):
   s = str(value).strip()
   if not s:
     return None
-  for fmt in ("%Y-%m-%d", "%m/%d/%Y", "%Y/%m/%d", "%m-%d-%Y"):
+  return _parse_date_cached(s)
+
+_DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%Y/%m/%d", "%m-%d-%Y")
+_last_date_fmt = _DATE_FORMATS[0]
+
+@lru_cache(maxsize=4096)
+def _parse_date_cached(s: str):
+  # Dates in one document tend to share a format, so try the last one that matched first
+  global _last_date_fmt
+  for fmt in (_last_date_fmt,) + _DATE_FORMATS:
     try:
-      return datetime.strptime(s, fmt).date()
+      d = datetime.strptime(s, fmt).date()
     except Exception:
       continue
+    _last_date_fmt = fmt
+    return d
   # If parsing fails, just return the original string
   return s
 
+_YES = frozenset({"yes", "y", "true", "1"})
+_NO = frozenset({"no", "n", "false", "0"})
+
 def _normalize_yesno(value: Any) -> str | None:
   if value is None:
     return None
   s = str(value).strip().lower()
-  if s in ("yes", "y", "true", "1"):
+  if s in _YES:
     return "Yes"
-  if s in ("no", "n", "false", "0"):
+  if s in _NO:
     return "No"
-  # Leave as-is if it's already something like "Yes"/"No" with different casing
-  if s:
-    return "Yes" if s == "yes" else ("No" if s == "no" else str(value))
-  return None
+  # Leave anything else as-is
+  return str(value) if s else None
+
+def _coerce_list(value: Any):
+  if isinstance(value, list):
+    return ", ".join([str(x) for x in value])
+  return str(value) if value is not None else None
+
+def _identity(value: Any):
+  return value
+
+# answer_type -> coercion; text, email, phone and anything unknown pass through
+_COERCERS = {
+  "date": _try_parse_date,
+  "number": _try_parse_number,
+  "currency": _try_parse_number,
+  "yesno": _normalize_yesno,
+  "list": _coerce_list,
+}
+
+# Placeholder strings the model uses for "no answer". "None", "N/A" and "Unknown" are
+# left alone: the first two are real checklist answers, the last is the writer's own
+# visible marker for missing answers.
+_JUNK = frozenset({"", "null"})
 
 def _coerce_for_cell(answer_value: Any, answer_type: str):
-  at = (answer_type or "text").lower().strip()
-  # Filter out "null" strings
-  if isinstance(answer_value, str) and answer_value.strip().lower() == "null":
-    return None
-  if at == "date":
-    return _try_parse_date(answer_value)
-  if at in ("number", "currency"):
-    return _try_parse_number(answer_value)
-  if at == "yesno":
-    return _normalize_yesno(answer_value)
-  if at == "list":
-    if isinstance(answer_value, list):
-      return ", ".join([str(x) for x in answer_value])
-    return str(answer_value) if answer_value is not None else None
-  # text, email, phone, default
-  return answer_value if answer_value is not None else None
-
-def _targets(row):
-  """
-  Given a mapping row, determine the worksheet, row index, and target columns for question and answer.
-  Returns (ws, row_idx, col_q, col_a, col_conf, col_src)
-  """
-  # Pick sheet (fallback to first sheet if mapping name not found)
-  wb = row._workbook  # must be set by fill_template
-  sheet_name = row.sheet if row.sheet in wb.sheetnames else wb.sheetnames[0]
-  ws = wb[sheet_name]
-  # Parse row.cell to get row index
-  from openpyxl.utils.cell import coordinate_from_string
-  cell = row.cell
-  if not cell:
-    return ws, None, None, None, None, None
+  """`answer_type` is a normalized mapping type (see mapping._ALIAS_MAP)."""
+  # Filter out "null"-style placeholders; the length gate skips lowercasing real answers
+  if isinstance(answer_value, str):
+    sv = answer_value.strip()
+    if len(sv) <= 4 and sv.lower() in _JUNK:
+      return None
+  return _COERCERS.get(answer_type, _identity)(answer_value)
+
+@lru_cache(maxsize=1024)
+def _cell_row(cell: str) -> int:
+  # The same mapping cells are written on every fill, so each address is parsed once
   col, idx = coordinate_from_string(cell)
-  row_idx = idx
-  # Column A: question, B: answer, C: Confidence, D: Source
-  return ws, row_idx, 1, 2, 3, 4
+  return idx
+
+_DATE_FORMAT = "mm/dd/yyyy"
 
 def _write_text(ws, row_idx, value, answer_type):
   cell = ws.cell(row=row_idx, column=2)
   val = _coerce_for_cell(value, answer_type)
   cell.value = val
-  if answer_type and answer_type.lower().strip() == "date":
-    if hasattr(val, "year") and hasattr(val, "month") and hasattr(val, "day"):
-      cell.number_format = "mm/dd/yyyy"
+  # answer_type arrives normalized from fill_template
+  if answer_type == "date":
+    # Only touch the format when it changes: assigning it rebuilds the cell's style array.
+    # (A NamedStyle would be cheaper still, but applying one resets the template's
+    # font/border/fill on the cell.)
+    if hasattr(val, "year") and hasattr(val, "month") and hasattr(val, "day") and cell.number_format != _DATE_FORMAT:
+      cell.number_format = _DATE_FORMAT
+
+@lru_cache(maxsize=4)
+def _template_bytes(path: str, mtime_ns: int) -> bytes:
+  # keyed on mtime so an edited template is picked up without a restart
+  return Path(path).read_bytes()
 
 def fill_template(mapping: Mapping, answers: Dict[str, Any], out_path: Path, excel_template: Path | None = None) -> Path:
   """
@@ -182,42 +209,52 @@ def fill_template(mapping: Mapping, answers: Dict[str, Any], out_path: Path, exc
   preserves all question text in column A,
   and writes answers into column B for text/date/number/percent, or C/D for yes/no.
   """
-  from .config import EXCEL_TEMPLATE
   tpl = excel_template or EXCEL_TEMPLATE
-  wb = load_workbook(tpl, data_only=False, keep_vba=False)
+  # The template's formatting must be preserved, so it is loaded in full (write-only
+  # mode can't modify an existing workbook); only the file read is cached across jobs
+  tpl = Path(tpl)
+  data = _template_bytes(str(tpl), tpl.stat().st_mtime_ns)
+  wb = load_workbook(BytesIO(data), data_only=False, keep_vba=False)
 
-  # Attach workbook to each mapping row for _targets
+  # Group rows by target sheet (fallback to first sheet if mapping name not found)
+  # so each worksheet is resolved once rather than per row
+  groups: Dict[str, list] = {}
   for row in mapping.question_rows:
-    row._workbook = wb
+    sheet_name = row.sheet if row.sheet in wb.sheetnames else wb.sheetnames[0]
+    groups.setdefault(sheet_name, []).append(row)
 
-  for row in mapping.question_rows:
-    key = row.json_key
-    if not key:
-      logging.warning(f"Skipping row with no json_key at {row.cell}")
-      continue
-    ws, row_idx, col_q, col_a, col_conf, col_src = _targets(row)
-    if ws is None or row_idx is None:
-      continue
-    # Preserve original question text in column A
-    orig_q = ws.cell(row=row_idx, column=col_q).value
-    ws.cell(row=row_idx, column=col_q, value=orig_q)
+  # Resolve every write target up front into flat (ws, row_idx, key, answer_type, cell) tuples
+  plan = []
+  for sheet_name, rows in groups.items():
+    ws = wb[sheet_name]
+    for row in rows:
+      if not row.json_key:
+        logging.warning(f"Skipping row with no json_key at {row.cell}")
+        continue
+      if not row.cell:
+        continue
+      # answer_type is already lowercased and alias-normalized by load_mapping
+      plan.append((ws, _cell_row(row.cell), row.json_key, row.answer_type or "text", row.cell))
 
+  # Column A (question text) is left untouched so the template's wording is preserved;
+  # B: answer, C: Confidence, D: Source
+  for ws, row_idx, key, answer_type, cell_ref in plan:
     raw_value = answers.get(key, None)
+    # Keys absent from the answers leave the template cells untouched, except yes/no
+    # rows, which are written as "Unknown" with confidence 3 and source "Unknown"
+    if raw_value is None and answer_type != "yesno":
+      continue
     value, conf, src = _extract_structured(raw_value)
 
-    # Ensure no literal "null" written for answer
-    answer_type = (row.answer_type or "text").lower().strip()
-
     try:
       _write_text(ws, row_idx, value, answer_type)
-      # Confidence & Source for every row, always write even if empty
+      # Confidence & Source for every answered row, always write even if empty
       _write_conf_source(ws, row_idx, conf, src)
     except Exception as e:
-      logging.warning(f"Failed to write answer for key {key} at {row.cell}: {e}")
-      ws.cell(row=row_idx, column=col_a, value=f"Error: {e}")
-      ws.cell(row=row_idx, column=col_conf, value="Error")
-      ws.cell(row=row_idx, column=col_src, value="Error")
-      continue
+      logging.warning(f"Failed to write answer for key {key} at {cell_ref}: {e}")
+      ws.cell(row=row_idx, column=2, value=f"Error: {e}")
+      ws.cell(row=row_idx, column=3, value="Error")
+      ws.cell(row=row_idx, column=4, value="Error")
 
   # Ensure parent directory exists and save
   out_path = Path(out_path)